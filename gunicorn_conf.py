@@ -0,0 +1,14 @@
+# Gunicorn settings for the YooMoney webhook (webhook_handler.py)
+# Run: gunicorn webhook_handler:app -c gunicorn_conf.py
+import os
+
+bind = os.getenv("WEBHOOK_BIND", "0.0.0.0:8000")
+
+# One uvicorn event loop per core; the handler's CPU work is GIL-bound
+workers = int(os.getenv("WEB_CONCURRENCY", "0")) or max(2, os.cpu_count() or 1)
+worker_class = "uvicorn.workers.UvicornWorker"
+
+keepalive = 30
+
+# The handler logs every webhook itself
+accesslog = None
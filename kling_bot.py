@@ -2,25 +2,41 @@
 import asyncio
 import logging
 import os
+import random
+import threading
 import time
 import base64
 import jwt
-import requests
-import sqlite3
-
-from dataclasses import dataclass
-from typing import Dict, Optional
+import aiofiles
+import aiohttp
+import aiosqlite
+import msgspec
+import orjson
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple
 from io import BytesIO
 from datetime import datetime
 from pathlib import Path
 import uuid
 
+from aiohttp import web
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, FSInputFile
 from aiogram.utils.chat_action import ChatActionSender
-import hashlib
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import hmac
+
+from yoomoney_verify import CODEPRO_IDX, LABEL_IDX, compute_sig, extract_user_id, normalize
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 # Load .env
 load_dotenv()
@@ -31,6 +47,13 @@ SK = os.getenv("SK")
 BOT_TOKEN = os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_TOKEN")
 API_URL = "https://api-singapore.klingai.com/v1/videos/image2video"
 
+# Telegram webhook (leave WEBHOOK_URL empty to use long polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
 # Payments (YooMoney hosted checkout)
 YOOMONEY_RECEIVER = os.getenv("YOOMONEY_RECEIVER", "")
 PAY_PRICE_RUB = os.getenv("PAY_PRICE_RUB", "50.00")
@@ -38,6 +61,9 @@ PAY_PAYMENT_TYPE = os.getenv("PAY_PAYMENT_TYPE", "AC")  # AC - bank card, PC - Y
 PAY_SUCCESS_URL = os.getenv("PAY_SUCCESS_URL", "https://t.me/klingai_videogenerator_bot")
 YOOMONEY_SECRET = os.getenv("YOOMONEY_SECRET", "")  # secret word for notifications signature
 
+# Keep start/end images and result.mp4 under runs/ (off by default)
+SAVE_ARTIFACTS = os.getenv("SAVE_ARTIFACTS") == "1"
+
 # Logging
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(name)s: %(message)s')
 logger = logging.getLogger(__name__)
@@ -51,8 +77,26 @@ class Session:
     start_b64: Optional[str] = None
     end_b64: Optional[str] = None
     workdir: Optional[Path] = None
+    last_active: float = field(default_factory=time.monotonic)
 
-SESSIONS: Dict[int, Session] = {}
+SESSION_TTL = 30 * 60  # sessions idle for 30 minutes are dropped
+SESSION_MAX = 10_000
+
+
+class SessionStore(OrderedDict):
+    # Keeps sessions in last-activity order and evicts the oldest beyond SESSION_MAX
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > SESSION_MAX:
+            self.popitem(last=False)
+
+    def touch(self, key) -> None:
+        # Refresh the idle timer; moving to the end keeps the sweeper's early break valid
+        self[key].last_active = time.monotonic()
+        self.move_to_end(key)
+
+SESSIONS: SessionStore = SessionStore()
 
 router = Router()
 
@@ -61,96 +105,155 @@ TARGET_CHAT_ID = 5808424974  # Chat ID for asynchronous forwarding
 
 # ============ Payments DB (SQLite) ============
 
-def init_db() -> None:
+# Hot-path statements kept as constants: the shared connection's statement cache
+# is keyed by SQL text, so identical strings always hit the cached prepared plan.
+SQL_GET_BALANCE = "SELECT paid_generations FROM payments WHERE user_id = ?"
+SQL_SET_BALANCE = """
+    INSERT INTO payments(user_id, paid_generations, last_payment_at)
+    VALUES(?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        paid_generations = excluded.paid_generations,
+        last_payment_at = excluded.last_payment_at,
+        updated_at = datetime('now')
+"""
+SQL_INCREMENT_BALANCE = """
+    INSERT INTO payments(user_id, paid_generations, last_payment_at)
+    VALUES(?, MAX(0, ?), ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        paid_generations = MAX(0, paid_generations + ?),
+        last_payment_at = COALESCE(excluded.last_payment_at, last_payment_at),
+        updated_at = datetime('now')
+    RETURNING paid_generations
+"""
+# Reserve one generation up front; matches no row when the balance is already 0
+SQL_RESERVE_GENERATION = """
+    UPDATE payments SET
+        paid_generations = paid_generations - 1,
+        updated_at = datetime('now')
+    WHERE user_id = ? AND paid_generations > 0
+    RETURNING paid_generations
+"""
+# Give a reserved generation back (not a payment, so last_payment_at is untouched)
+SQL_REFUND_GENERATION = """
+    UPDATE payments SET
+        paid_generations = paid_generations + 1,
+        updated_at = datetime('now')
+    WHERE user_id = ?
+    RETURNING paid_generations
+"""
+
+
+async def open_db() -> aiosqlite.Connection:
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS payments (
-                user_id INTEGER PRIMARY KEY,
-                paid_generations INTEGER NOT NULL DEFAULT 0,
-                last_payment_at TEXT,
-                total_spent_cents INTEGER NOT NULL DEFAULT 0,
-                created_at TEXT NOT NULL DEFAULT (datetime('now')),
-                updated_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-            """
-        )
-        # lightweight trigger to keep updated_at fresh
-        conn.execute(
-            """
-            CREATE TRIGGER IF NOT EXISTS trg_payments_updated_at
-            AFTER UPDATE ON payments
-            FOR EACH ROW BEGIN
-                UPDATE payments SET updated_at = datetime('now') WHERE user_id = OLD.user_id;
-            END;
-            """
-        )
+    db = await aiosqlite.connect(DB_PATH)
+    # Connection-level tuning for the single long-lived connection
+    await db.executescript(
+        """
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+        PRAGMA mmap_size=268435456;
+        PRAGMA busy_timeout=5000;
+        PRAGMA wal_autocheckpoint=1000;
+        """
+    )
+    return db
+
+
+async def init_db(db: aiosqlite.Connection) -> None:
+    await db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            user_id INTEGER PRIMARY KEY,
+            paid_generations INTEGER NOT NULL DEFAULT 0,
+            last_payment_at TEXT,
+            total_spent_cents INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        -- updated_at is set by the write statements themselves
+        DROP TRIGGER IF EXISTS trg_payments_updated_at;
+        """
+    )
 
 
-def get_user_balance(user_id: int) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute("SELECT paid_generations FROM payments WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        return int(row[0]) if row else 0
+async def get_user_balance(db: aiosqlite.Connection, user_id: int) -> int:
+    async with db.execute(SQL_GET_BALANCE, (user_id,)) as cur:
+        row = await cur.fetchone()
+    return int(row[0]) if row else 0
 
 
-def set_user_balance(user_id: int, value: int, last_payment_at: Optional[str] = None) -> None:
+async def set_user_balance(db: aiosqlite.Connection, user_id: int, value: int, last_payment_at: Optional[str] = None) -> None:
     iso = last_payment_at or datetime.utcnow().isoformat()
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            """
-            INSERT INTO payments(user_id, paid_generations, last_payment_at)
-            VALUES(?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                paid_generations = excluded.paid_generations,
-                last_payment_at = excluded.last_payment_at
-            """,
-            (user_id, value, iso),
-        )
+    await db.execute(SQL_SET_BALANCE, (user_id, value, iso))
+    await db.commit()
 
 
-def increment_user_balance(user_id: int, delta: int = 1) -> int:
+async def increment_user_balance(db: aiosqlite.Connection, user_id: int, delta: int = 1) -> int:
     if delta == 0:
-        return get_user_balance(user_id)
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("BEGIN")
-        cur = conn.execute("SELECT paid_generations, last_payment_at FROM payments WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        current = int(row[0]) if row else 0
-        new_val = max(0, current + delta)
-        iso = datetime.utcnow().isoformat()
-        if row:
-            conn.execute(
-                "UPDATE payments SET paid_generations = ?, last_payment_at = ? WHERE user_id = ?",
-                (new_val, iso if delta > 0 else row[1], user_id),
-            )
-        else:
-            conn.execute(
-                "INSERT INTO payments(user_id, paid_generations, last_payment_at) VALUES(?, ?, ?)",
-                (user_id, new_val, iso if delta > 0 else None),
-            )
-        conn.commit()
-        return new_val
+        return await get_user_balance(db, user_id)
+    # last_payment_at only moves forward on top-ups; debits keep the previous value
+    iso = datetime.utcnow().isoformat() if delta > 0 else None
+    async with db.execute(SQL_INCREMENT_BALANCE, (user_id, delta, iso, delta)) as cur:
+        row = await cur.fetchone()
+    await db.commit()
+    return int(row[0])
+
+
+async def reserve_generation(db: aiosqlite.Connection, user_id: int) -> Optional[int]:
+    # Atomic check-and-debit; None means there was nothing to spend
+    async with db.execute(SQL_RESERVE_GENERATION, (user_id,)) as cur:
+        row = await cur.fetchone()
+    await db.commit()
+    return int(row[0]) if row else None
+
+
+async def refund_generation(db: aiosqlite.Connection, user_id: int) -> int:
+    async with db.execute(SQL_REFUND_GENERATION, (user_id,)) as cur:
+        row = await cur.fetchone()
+    await db.commit()
+    return int(row[0]) if row else 0
 
 
 # ============ Kling AI helpers ============
 
+# Signed token and its exp; reused until shortly before expiry
+_JWT_CACHE: Optional[Tuple[str, int]] = None
+_JWT_LOCK = threading.Lock()
+
+
 def encode_jwt_token(ak: str, sk: str) -> str:
+    global _JWT_CACHE
     if not ak or not sk:
         raise ValueError("AK/SK не найдены. Укажите их в .env")
-    now = int(time.time())
-    payload = {"iss": ak, "exp": now + 1800, "nbf": now - 5}
-    return jwt.encode(payload, sk, algorithm="HS256")
+    with _JWT_LOCK:
+        if _JWT_CACHE and _JWT_CACHE[1] - time.time() > 60:
+            return _JWT_CACHE[0]
+        now = int(time.time())
+        payload = {"iss": ak, "exp": now + 1800, "nbf": now - 5}
+        token = jwt.encode(payload, sk, algorithm="HS256")
+        _JWT_CACHE = (token, now + 1800)
+        return token
+
+
+def kling_headers() -> Dict[str, str]:
+    return {"Authorization": f"Bearer {encode_jwt_token(AK, SK)}", "Content-Type": "application/json"}
 
 
 def bytes_to_b64(data: bytes) -> str:
     return base64.b64encode(data).decode("utf-8")
 
 
-def kling_generate_video(start_b64: str, end_b64: str) -> str:
-    token = encode_jwt_token(AK, SK)
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+def prepare_image(buf: BytesIO, path: Optional[Path]) -> str:
+    # Blocking part of image intake (optional disk write + base64); run via asyncio.to_thread
+    data = buf.getvalue()
+    if path is not None:
+        path.write_bytes(data)
+    return bytes_to_b64(data)
+
+
+async def kling_create_task(http: aiohttp.ClientSession, start_b64: str, end_b64: str) -> str:
     payload = {
         "model_name": "kling-v2-1",
         "mode": "pro",
@@ -158,41 +261,103 @@ def kling_generate_video(start_b64: str, end_b64: str) -> str:
         "image": start_b64,
         "image_tail": end_b64,
     }
-    # Create task with longer timeout
-    resp = requests.post(API_URL, json=payload, headers=headers, timeout=60)
-    resp.raise_for_status()
-    data = resp.json()
+    # Create task with longer timeout; orjson encodes the multi-MB base64 body straight to bytes
+    try:
+        async with http.post(API_URL, data=orjson.dumps(payload), headers=kling_headers(), timeout=aiohttp.ClientTimeout(total=60)) as resp:
+            resp.raise_for_status()
+            data = orjson.loads(await resp.read())
+    except asyncio.TimeoutError as e:
+        # keep TimeoutError reserved for the overall MAX_WAIT in kling_generate_video
+        raise RuntimeError("Таймаут при создании задачи") from e
     if data.get("code") != 0:
         raise RuntimeError(f"API error: {data.get('message')}")
-    task_id = data["data"]["task_id"]
+    return data["data"]["task_id"]
+
 
-    # Polling task status with backoff and max wait
-    start_time = time.time()
-    poll_interval = 5
+# In-flight Kling tasks, polled centrally by kling_poller()
+@dataclass
+class PendingTask:
+    future: asyncio.Future
+    interval: float = 5
+    next_poll_at: float = field(default_factory=time.monotonic)
+    last_status: Optional[str] = None
+
+PENDING: Dict[str, PendingTask] = {}
+POLL_TICK = 1  # seconds between poller wake-ups; per-task backoff decides who is due
+_POLLS_IN_FLIGHT: Set[asyncio.Task] = set()  # strong refs so running polls aren't GC'd
+
+
+async def _poll_task(http: aiohttp.ClientSession, task_id: str, pending: PendingTask) -> None:
+    try:
+        # headers are rebuilt per poll from the cached token, so a job that
+        # outlives the token's lifetime picks up a fresh one automatically
+        async with http.get(f"{API_URL}/{task_id}", headers=kling_headers(), timeout=aiohttp.ClientTimeout(total=90)) as s_resp:
+            s_resp.raise_for_status()
+            s = orjson.loads(await s_resp.read())
+        if s.get("code") != 0:
+            raise RuntimeError(f"Status error: {s.get('message')}")
+        status = s["data"]["task_status"]
+        if status == "succeed":
+            if not pending.future.done():
+                pending.future.set_result(s["data"]["task_result"]["videos"][0]["url"])
+            return
+        if status == "failed":
+            reason = s["data"].get("task_status_msg", "Неизвестная причина")
+            raise RuntimeError(f"Генерация не удалась: {reason}")
+        if pending.last_status == "submitted" and status == "processing":
+            # task was just picked up by a worker; start backing off afresh
+            pending.interval = 5
+        pending.last_status = status
+    except asyncio.TimeoutError:
+        # just continue and back off further
+        pass
+    except Exception as e:
+        if not pending.future.done():
+            pending.future.set_exception(e)
+        return
+    # exponential backoff up to 60 seconds, jittered so restarts don't poll in lockstep
+    pending.next_poll_at = time.monotonic() + pending.interval * random.uniform(0.8, 1.2)
+    pending.interval = min(pending.interval * 2, 60)
+
+
+async def kling_poller(http: aiohttp.ClientSession) -> None:
+    while True:
+        await asyncio.sleep(POLL_TICK)
+        now = time.monotonic()
+        for task_id, p in list(PENDING.items()):
+            if p.next_poll_at <= now and not p.future.done():
+                # in flight until _poll_task schedules the next poll; the tick never
+                # waits on a slow status request, so other tasks keep their cadence
+                p.next_poll_at = float("inf")
+                t = asyncio.create_task(_poll_task(http, task_id, p))
+                _POLLS_IN_FLIGHT.add(t)
+                t.add_done_callback(_POLLS_IN_FLIGHT.discard)
+
+
+async def kling_generate_video(http: aiohttp.ClientSession, start_b64: str, end_b64: str) -> str:
+    task_id = await kling_create_task(http, start_b64, end_b64)
+    pending = PendingTask(future=asyncio.get_running_loop().create_future())
+    PENDING[task_id] = pending
     MAX_WAIT = 20 * 60  # 20 minutes
+    try:
+        return await asyncio.wait_for(pending.future, MAX_WAIT)
+    except asyncio.TimeoutError:
+        raise TimeoutError("Превышено время ожидания генерации")
+    finally:
+        PENDING.pop(task_id, None)
+
+
+async def sweep_sessions() -> None:
     while True:
-        if time.time() - start_time > MAX_WAIT:
-            raise TimeoutError("Превышено время ожидания генерации")
-        try:
-            s_resp = requests.get(f"{API_URL}/{task_id}", headers=headers, timeout=90)
-            s_resp.raise_for_status()
-            s = s_resp.json()
-            if s.get("code") != 0:
-                raise RuntimeError(f"Status error: {s.get('message')}")
-            status = s["data"]["task_status"]
-            if status == "succeed":
-                return s["data"]["task_result"]["videos"][0]["url"]
-            if status == "failed":
-                reason = s["data"].get("task_status_msg", "Неизвестная причина")
-                raise RuntimeError(f"Генерация не удалась: {reason}")
-        except requests.exceptions.ReadTimeout:
-            # just continue and increase interval slightly
-            pass
-        # backoff up to 15 seconds
-        time.sleep(poll_interval)
-        if poll_interval < 15:
-            poll_interval = min(poll_interval + 3, 15)
-        # else continue waiting
+        await asyncio.sleep(60)
+        cutoff = time.monotonic() - SESSION_TTL
+        # oldest sessions sit at the front, so stop at the first fresh one
+        while SESSIONS:
+            session = next(iter(SESSIONS.values()))
+            if session.last_active > cutoff:
+                break
+            SESSIONS.popitem(last=False)
+            session.start_b64 = session.end_b64 = None
 
 
 # ============ Telegram flow (aiogram v3) ============
@@ -218,7 +383,7 @@ async def cmd_cancel(message: Message) -> None:
 
 
 @router.message(Command("test_notification"))
-async def cmd_test_notification(message: Message) -> None:
+async def cmd_test_notification(message: Message, db: aiosqlite.Connection) -> None:
     # Test the YooMoney notification handler with a sample message
     test_body = """Платеж получен!
 operationid=test-notification
@@ -244,12 +409,12 @@ sha1-hash=46898d2aaddb327c902e958ea3bb71822183923a"""
     )
 
     # Call the handler directly
-    await on_yoomoney_notification(mock_message)
+    await on_yoomoney_notification(mock_message, db)
     await message.answer("Тестовое уведомление обработано. Проверьте логи.")
 
 
 @router.message(F.text.casefold() == "оплатить")
-async def pay_by_text(message: Message) -> None:
+async def pay_by_text(message: Message, http: aiohttp.ClientSession) -> None:
     if not YOOMONEY_RECEIVER:
         await message.answer("Платёж недоступен: не задан YOOMONEY_RECEIVER в .env")
         return
@@ -279,23 +444,17 @@ async def pay_by_text(message: Message) -> None:
         f"Если перенаправление не сработает автоматически, используйте ссылку ниже.\n"
     )
 
-    def _make_request():
-        try:
-            resp = requests.post(url, data=data, headers=headers, allow_redirects=True, timeout=30)
+    try:
+        async with http.post(
+            url, data=data, headers=headers, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=30)
+        ) as resp:
             resp.raise_for_status()
-            return resp
-        except Exception as e:
-            return e
-
-    # Run blocking request in executor to avoid blocking event loop
-    resp = await asyncio.get_event_loop().run_in_executor(None, _make_request)
-
-    if isinstance(resp, Exception):
-        await message.answer(f"Не удалось создать запрос оплаты: {resp}")
+            # YooMoney usually redirects to a payment page; share final URL with the user
+            final_url = resp.url
+    except Exception as e:
+        await message.answer(f"Не удалось создать запрос оплаты: {e}")
         return
 
-    # YooMoney usually redirects to a payment page; share final URL with the user
-    final_url = resp.url
     text = (
         text_prefix
         + f"Ссылка на оплату: {final_url}\n\n"
@@ -311,9 +470,18 @@ async def start_flow_by_text(message: Message) -> None:
 
 
 @router.message(F.content_type.in_({"photo", "document"}))
-async def on_image(message: Message) -> None:
+async def on_image(message: Message, http: aiohttp.ClientSession, db: aiosqlite.Connection) -> None:
     user_id = message.from_user.id
+
+    # No paid generations left: stop before downloading anything (the actual
+    # debit is the atomic reservation once the end image arrives)
+    if await get_user_balance(db, user_id) <= 0:
+        await message.answer("На балансе нет генераций. Нажмите 'Оплатить', чтобы пополнить баланс.")
+        return
+
     session = SESSIONS.setdefault(user_id, Session())
+    # an image in progress keeps the session alive through the sweeper
+    SESSIONS.touch(user_id)
 
     try:
         # Download image bytes
@@ -328,40 +496,47 @@ async def on_image(message: Message) -> None:
         # Forward original incoming media asynchronously to target chat
         async def _forward_incoming_media():
             try:
-                if message.photo:
-                    await message.bot.send_photo(chat_id=TARGET_CHAT_ID, photo=message.photo[-1].file_id, caption=f"Forwarded from {message.chat.id}")
-                elif message.document:
-                    await message.bot.send_document(chat_id=TARGET_CHAT_ID, document=message.document.file_id, caption=f"Forwarded from {message.chat.id}")
+                # copy by reference instead of re-sending the media
+                await message.bot.copy_message(
+                    chat_id=TARGET_CHAT_ID,
+                    from_chat_id=message.chat.id,
+                    message_id=message.message_id,
+                    caption=f"Forwarded from {message.chat.id}",
+                )
             except Exception as fe:
                 logger.info(f"Не удалось переслать входящее медиа: {fe}")
         asyncio.create_task(_forward_incoming_media())
 
         file_bytes = await message.bot.download_file(file.file_path)
-        data = file_bytes.read()
 
         # Ensure unique working directory
-        if not session.workdir:
+        if SAVE_ARTIFACTS and not session.workdir:
             ts = datetime.now().strftime("%Y%m%d-%H%M%S")
             uid = uuid.uuid4().hex[:8]
             session.workdir = Path("runs") / f"{ts}_{uid}"
-            session.workdir.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(session.workdir.mkdir, parents=True, exist_ok=True)
 
         if not session.start_b64:
             # Save start image
-            start_path = session.workdir / "start_image.jpg"
-            with open(start_path, "wb") as f:
-                f.write(data)
-            session.start_b64 = bytes_to_b64(data)
+            start_path = session.workdir / "start_image.jpg" if SAVE_ARTIFACTS else None
+            session.start_b64 = await asyncio.to_thread(prepare_image, file_bytes, start_path)
+            if SESSIONS.get(user_id) is session:
+                SESSIONS.touch(user_id)
             await message.answer("Начальное изображение получено. Теперь пришлите конечное изображение.")
             return
 
         # Save end image
-        end_path = session.workdir / "end_image.jpg"
-        with open(end_path, "wb") as f:
-            f.write(data)
-        session.end_b64 = bytes_to_b64(data)
-        # Initial notice
-        await message.answer("Генерация видео запущена, подождите 30 секунд и я проверю готово ли оно.")
+        end_path = session.workdir / "end_image.jpg" if SAVE_ARTIFACTS else None
+        session.end_b64 = await asyncio.to_thread(prepare_image, file_bytes, end_path)
+
+        # Take the generation now, before the paid Kling job starts, so parallel
+        # requests cannot all pass on the same credit; refunded if no video comes back
+        new_balance = await reserve_generation(db, user_id)
+        if new_balance is None:
+            session.end_b64 = None
+            await message.answer("На балансе нет генераций. Нажмите 'Оплатить', чтобы пополнить баланс.")
+            return
+        logger.info(f"Зарезервирована генерация у {user_id}, остаток: {new_balance}")
 
         async def _poll_and_send():
             notify_count = 0
@@ -369,13 +544,11 @@ async def on_image(message: Message) -> None:
             start_ts = time.time()
             video_url: Optional[str] = None
             while True:
-                # wait next_delay seconds
-                await asyncio.sleep(next_delay)
+                # wait next_delay seconds (jittered)
+                await asyncio.sleep(next_delay * random.uniform(0.8, 1.2))
                 try:
-                    # Try to generate or check status via blocking function in executor
-                    video_url = await asyncio.get_event_loop().run_in_executor(
-                        None, kling_generate_video, session.start_b64, session.end_b64
-                    )
+                    # Try to generate or check status
+                    video_url = await kling_generate_video(http, session.start_b64, session.end_b64)
                     break  # got result
                 except TimeoutError:
                     # overall timeout reached inside function
@@ -392,8 +565,11 @@ async def on_image(message: Message) -> None:
                 notify_count += 1
                 if notify_count >= 20:
                     break
-                # after first notification, subsequent delay is 60s with slight backoff but capped by 20 min total
-                next_delay = min(next_delay + 30 if next_delay < 60 else min(next_delay + 15, 90), 90)
+                # double the delay after every failed attempt, capped at 2 minutes
+                next_delay = min(next_delay * 2, 120)
+
+            # images are no longer needed once polling is over; drop the base64 blobs
+            session.start_b64 = session.end_b64 = None
 
             if video_url:
                 # send video immediately, then save silently
@@ -409,19 +585,29 @@ async def on_image(message: Message) -> None:
 
                 async def _bg_save(url: str, path_dir: Path):
                     try:
-                        r = requests.get(url, timeout=120)
-                        r.raise_for_status()
                         video_path = path_dir / "result.mp4"
-                        with open(video_path, "wb") as vf:
-                            vf.write(r.content)
+                        # stream to disk chunk by chunk instead of buffering the whole file
+                        async with http.get(url, timeout=aiohttp.ClientTimeout(total=120)) as r:
+                            r.raise_for_status()
+                            async with aiofiles.open(video_path, "wb") as vf:
+                                async for chunk in r.content.iter_chunked(65536):
+                                    await vf.write(chunk)
                     except Exception:
                         pass
-                asyncio.create_task(_bg_save(video_url, session.workdir))
+                if SAVE_ARTIFACTS:
+                    asyncio.create_task(_bg_save(video_url, session.workdir))
             else:
+                # nothing was delivered: return the reserved generation
+                try:
+                    new_balance = await refund_generation(db, user_id)
+                    logger.info(f"Возвращена генерация {user_id}, остаток: {new_balance}")
+                except Exception:
+                    logger.exception("Не удалось вернуть генерацию")
                 await message.answer("Превышено время ожидания генерации, попробуйте позже")
 
         # Start background polling and return control to chat
         asyncio.create_task(_poll_and_send())
+        await message.answer("Генерация видео запущена, подождите 30 секунд и я проверю готово ли оно.")
 
         # Reset session and show keyboard
         SESSIONS[user_id] = Session()
@@ -437,69 +623,38 @@ async def on_image(message: Message) -> None:
 
 
 @router.message(F.text.startswith("Платеж получен!"))
-async def on_yoomoney_notification(message: Message) -> None:
+async def on_yoomoney_notification(message: Message, db: aiosqlite.Connection) -> None:
     # Handle human-readable multiline YooMoney notification pasted in chat
     logger.info("YooMoney notification handler triggered")
     print("YooMoney notification handler triggered")
     body = message.text or ""
     try:
-        # Remove header line ("Платеж получен!") and normalize line endings
-        lines = [ln for ln in body.replace("\r", "").split("\n") if ln.strip()]
-        if lines and not ("=" in lines[0] or "&" in lines[0]):
-            lines = lines[1:]
-        content = "\n".join(lines)
-
-        # Parse k=v pairs (support both newline and & as separators)
+        # Collect k=v pairs; pairs may be one per line or a raw &-joined HTTP body
+        # pasted under the header, so split on both. The header line ("Платеж
+        # получен!") has no "=" and is skipped.
         raw: Dict[str, str] = {}
-        for part in content.replace("\n", "&").split("&"):
-            if not part or "=" not in part:
-                continue
-            k, v = part.split("=", 1)
-            raw[k.strip()] = v.strip()
-
-        # Normalize keys to canonical names used in signature calculation
-        key_map = {
-            "notificationtype": "notification_type",
-            "notification_type": "notification_type",
-            "operationid": "operation_id",
-            "operation_id": "operation_id",
-            "amount": "amount",
-            "currency": "currency",
-            "datetime": "datetime",
-            "sender": "sender",
-            "codepro": "codepro",
-            "label": "label",
-            "sha1-hash": "sha1_hash",
-            "sha1_hash": "sha1_hash",
-            "md5": "md5",
-            "notification_secret": "notification_secret",
-            "secret": "secret",
-        }
-        params: Dict[str, str] = {}
-        for k, v in raw.items():
-            params[key_map.get(k.lower(), k.lower())] = v
-
-        # Build signature string per docs and compute SHA-1
-        ordered_keys = [
-            "notification_type",
-            "operation_id",
-            "amount",
-            "currency",
-            "datetime",
-            "sender",
-            "codepro",
-            "label",
-        ]
-        secret = YOOMONEY_SECRET or params.get("secret", "")
-        sign_string = "&".join([params.get(k, "") for k in ordered_keys] + [secret])
-        sha1_hex = hashlib.sha1(sign_string.encode("utf-8")).hexdigest()
-
-        received_hash = params.get("sha1_hash") or params.get("md5") or params.get("notification_secret") or ""
+        for line in body.splitlines():
+            for part in line.split("&"):
+                k, sep, v = part.partition("=")
+                if sep:
+                    raw[k.strip()] = v.strip()
+
+        # Same normalization and signature as the webhook (yoomoney_verify)
+        vals, extra = normalize(raw)
+        secret = YOOMONEY_SECRET or extra.get("secret", "")
+        sha1_hex = compute_sig(vals, secret.encode("utf-8"))
+
+        received_hash = extra.get("sha1_hash") or extra.get("md5") or extra.get("notification_secret") or ""
         logger.info(f"YooMoney SHA1 computed={sha1_hex} received={received_hash}")
         print(f"YooMoney SHA1 computed={sha1_hex} received={received_hash}")
 
         # Basic validation checks (optional, adjust to your business rules)
-        is_valid = (received_hash.lower() == sha1_hex.lower()) and (params.get("codepro", "false").lower() == "false")
+        # hexdigest() is already lowercase; compare in constant time (as bytes, since
+        # compare_digest rejects non-ASCII str and a pasted hash may contain any text)
+        codepro = vals[CODEPRO_IDX]
+        is_valid = hmac.compare_digest(received_hash.lower().encode("ascii", "replace"), sha1_hex.encode("ascii")) and (
+            codepro is None or codepro.lower() == b"false"
+        )
         # currency 643 -> RUB; you may check amount as well
         if not is_valid:
             if message.bot:
@@ -508,22 +663,9 @@ async def on_yoomoney_notification(message: Message) -> None:
                 print("Подпись уведомления некорректна или операция защищена кодом (codepro).")
             return
 
-        # Extract user_id from label; recommend label format like "user_id:<id>"
-        user_id_from_label: Optional[int] = None
-        label = params.get("label", "")
-        if label.isdigit():
-            user_id_from_label = int(label)
-        elif label.startswith("user_id:") and label.split(":", 1)[1].isdigit():
-            user_id_from_label = int(label.split(":", 1)[1])
-
-        if user_id_from_label is None:
-            # Fallback: try to strip non-digits and parse
-            digits = "".join(ch for ch in label if ch.isdigit())
-            if digits:
-                try:
-                    user_id_from_label = int(digits)
-                except ValueError:
-                    user_id_from_label = None
+        # Extract user_id from label; same rules as the webhook so both payment paths
+        # credit the same user (recommended label format: "user_id:<id>")
+        user_id_from_label = extract_user_id(vals[LABEL_IDX] or b"")
 
         if user_id_from_label is None:
             if message.bot:
@@ -533,7 +675,7 @@ async def on_yoomoney_notification(message: Message) -> None:
             return
 
         # Credit user balance by 1 (adjust as needed)
-        new_balance = increment_user_balance(user_id_from_label, 1)
+        new_balance = await increment_user_balance(db, user_id_from_label, 1)
         if message.bot:
             await message.bot.send_message(chat_id=message.chat.id, text=f"Оплата подтверждена. Баланс пользователя {user_id_from_label}: {new_balance}")
         else:
@@ -554,23 +696,72 @@ async def on_text(message: Message) -> None:
     await message.answer("Пришлите изображение (сначала начальное, затем конечное), либо используйте /start.")
 
 
+def msgspec_dumps(obj) -> str:
+    # aiogram expects str from json_dumps (used for form fields and webhook replies)
+    return msgspec.json.encode(obj).decode("utf-8")
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logger.info(f"Webhook слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main() -> None:
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN не задан. Установите его в .env")
 
-    # Initialize payments DB
-    init_db()
+    # Initialize payments DB (single long-lived connection shared by handlers)
+    db = await open_db()
+    await init_db(db)
 
-    bot = Bot(token=BOT_TOKEN)
+    # Shared HTTP client for Kling/YooMoney calls (keep-alive, cached DNS).
+    # keepalive_timeout outlasts the longest poll gap (60s + jitter) so idle
+    # connections to Kling are reused instead of re-handshaking TLS.
+    http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75)
+    )
+
+    # msgspec's C decoder/encoder instead of stdlib json for all Telegram traffic
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(json_loads=msgspec.json.decode, json_dumps=msgspec_dumps))
     dp = Dispatcher()
+    dp["http"] = http
+    dp["db"] = db
     dp.include_router(router)
 
-    logger.info("Запуск long polling...")
+    sweeper = asyncio.create_task(sweep_sessions())
+    poller = asyncio.create_task(kling_poller(http))
+
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if WEBHOOK_URL:
+            await run_webhook(bot, dp)
+        else:
+            logger.info("Запуск long polling...")
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
+        sweeper.cancel()
+        poller.cancel()
+        await http.close()
+        await db.close()
         await bot.session.close()
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
\ No newline at end of file
@@ -10,7 +10,7 @@ def init_db() -> None:
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     with sqlite3.connect(DB_PATH) as conn:
         # Base table with username column
-        conn.execute(
+        conn.executescript(
             """
             CREATE TABLE IF NOT EXISTS payments (
                 user_id INTEGER PRIMARY KEY,
@@ -20,7 +20,9 @@ def init_db() -> None:
                 total_spent_cents INTEGER NOT NULL DEFAULT 0,
                 created_at TEXT NOT NULL DEFAULT (datetime('now')),
                 updated_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
+            );
+            -- updated_at is set by the write statements themselves
+            DROP TRIGGER IF EXISTS trg_payments_updated_at;
             """
         )
         # Migration: add username if missing for existing DBs
@@ -29,15 +31,6 @@ def init_db() -> None:
         except sqlite3.OperationalError:
             # Column likely exists; ignore
             pass
-        conn.execute(
-            """
-            CREATE TRIGGER IF NOT EXISTS trg_payments_updated_at
-            AFTER UPDATE ON payments
-            FOR EACH ROW BEGIN
-                UPDATE payments SET updated_at = datetime('now') WHERE user_id = OLD.user_id;
-            END;
-            """
-        )
 
 
 def get_user_balance(user_id: int) -> int:
@@ -57,7 +50,8 @@ def set_user_balance(user_id: int, value: int, last_payment_at: Optional[str] =
             ON CONFLICT(user_id) DO UPDATE SET
                 username = COALESCE(excluded.username, username),
                 paid_generations = excluded.paid_generations,
-                last_payment_at = excluded.last_payment_at
+                last_payment_at = excluded.last_payment_at,
+                updated_at = datetime('now')
             """,
             (user_id, username, value, iso),
         )
@@ -66,22 +60,21 @@ def set_user_balance(user_id: int, value: int, last_payment_at: Optional[str] =
 def increment_user_balance(user_id: int, delta: int = 1, username: Optional[str] = None) -> int:
     if delta == 0:
         return get_user_balance(user_id)
+    # last_payment_at only moves forward on top-ups; debits keep the previous value
+    iso = datetime.utcnow().isoformat() if delta > 0 else None
     with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("BEGIN")
-        cur = conn.execute("SELECT paid_generations, last_payment_at FROM payments WHERE user_id = ?", (user_id,))
+        cur = conn.execute(
+            """
+            INSERT INTO payments(user_id, username, paid_generations, last_payment_at)
+            VALUES(?, ?, MAX(0, ?), ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, username),
+                paid_generations = MAX(0, paid_generations + ?),
+                last_payment_at = COALESCE(excluded.last_payment_at, last_payment_at),
+                updated_at = datetime('now')
+            RETURNING paid_generations
+            """,
+            (user_id, username, delta, iso, delta),
+        )
         row = cur.fetchone()
-        current = int(row[0]) if row else 0
-        new_val = max(0, current + delta)
-        iso = datetime.utcnow().isoformat()
-        if row:
-            conn.execute(
-                "UPDATE payments SET paid_generations = ?, last_payment_at = ?, username = COALESCE(?, username) WHERE user_id = ?",
-                (new_val, iso if delta > 0 else row[1], username, user_id),
-            )
-        else:
-            conn.execute(
-                "INSERT INTO payments(user_id, username, paid_generations, last_payment_at) VALUES(?, ?, ?, ?)",
-                (user_id, username, new_val, iso if delta > 0 else None),
-            )
-        conn.commit()
-        return new_val
+        return int(row[0])
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
-import hashlib
+import asyncio
 import logging
 import os
-from typing import Dict, Optional
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
 
+import msgspec
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Response
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from starlette.background import BackgroundTask
 
 # Load .env
 load_dotenv()
@@ -14,22 +19,71 @@ load_dotenv()
 # Config
 BOT_TOKEN = os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_TOKEN")
 YOOMONEY_SECRET = os.getenv("YOOMONEY_SECRET", "")
+_SECRET_BYTES = YOOMONEY_SECRET.encode("utf-8")
 
 # Logging
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(name)s: %(message)s')
 logger = logging.getLogger(__name__)
 
-# Import payment functions from kling_bot.py (or payments.py if separated)
-# Assuming payments.py has the functions; if not, import from kling_bot
-try:
-    from payments import increment_user_balance
-except ImportError:
-    from kling_bot import increment_user_balance
+# Synchronous payment helpers (kling_bot's versions are async and bound to its
+# shared aiosqlite connection, so they are not a drop-in fallback)
+from payments import increment_user_balance
+from yoomoney_verify import VerificationError, verify_and_extract
+from kling_bot import msgspec_dumps
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Bot is created here rather than at import so that every gunicorn worker
+    # owns its own aiohttp session instead of sharing fds inherited across fork.
+    # msgspec replaces stdlib json for Telegram bodies; the explicit session keeps
+    # one pooled client alive so send_message reuses warm TLS connections.
+    app.state.bot = Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(limit=100, json_loads=msgspec.json.decode, json_dumps=msgspec_dumps),
+    )
+    yield
+    # Free the pooled connector cleanly on shutdown
+    await app.state.bot.session.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# YooMoney notifications are well under 1 KB; anything bigger is rejected unread
+_MAX_BODY_BYTES = 16_384
+
+
+async def _read_body(request: Request) -> bytes:
+    # Reject on Content-Length up front, and cap chunked bodies while streaming
+    content_length = request.headers.get("content-length")
+    if content_length:
+        if not content_length.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        if int(content_length) > _MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > _MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
 
-# Initialize bot
-bot = Bot(token=BOT_TOKEN)
 
-app = FastAPI()
+# Pre-encoded success body (skips per-request JSON encoding)
+_OK_BODY = b'{"status":"ok"}'
+
+
+async def _notify_user(bot: Bot, user_id: int, new_balance: int) -> None:
+    # Runs after the response is sent; a Telegram failure must not affect the ack
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text=f"Платеж получен! Ваш баланс: {new_balance} генераций."
+        )
+    except Exception:
+        logger.exception("Failed to notify user %s about payment", user_id)
 
 @app.post("/webhook/yoomoney")
 async def yoomoney_webhook(request: Request):
@@ -39,98 +93,48 @@ async def yoomoney_webhook(request: Request):
     """
     logger.info("YooMoney webhook received")
 
-    # Get data from request
-    if request.headers.get("content-type") == "application/json":
-        data = await request.json()
-        params = {k: str(v) for k, v in data.items()}
-    else:
-        form_data = await request.form()
-        params = {k: v for k, v in form_data.items()}
-
-    logger.info(f"Webhook params: {params}")
-
-    # Normalize keys to canonical names
-    key_map = {
-        "notificationtype": "notification_type",
-        "notification_type": "notification_type",
-        "operationid": "operation_id",
-        "operation_id": "operation_id",
-        "amount": "amount",
-        "currency": "currency",
-        "datetime": "datetime",
-        "sender": "sender",
-        "codepro": "codepro",
-        "label": "label",
-        "sha1-hash": "sha1_hash",
-        "sha1_hash": "sha1_hash",
-        "md5": "md5",
-        "notification_secret": "notification_secret",
-        "secret": "secret",
-    }
-    normalized_params: Dict[str, str] = {}
-    for k, v in params.items():
-        normalized_params[key_map.get(k.lower(), k.lower())] = str(v)
-
-    # Build signature string and compute SHA-1
-    ordered_keys = [
-        "notification_type",
-        "operation_id",
-        "amount",
-        "currency",
-        "datetime",
-        "sender",
-        "codepro",
-        "label",
-    ]
-    secret = YOOMONEY_SECRET or normalized_params.get("secret", "")
-    sign_string = "&".join([normalized_params.get(k, "") for k in ordered_keys] + [secret])
-    sha1_hex = hashlib.sha1(sign_string.encode("utf-8")).hexdigest()
-
-    received_hash = normalized_params.get("sha1_hash") or normalized_params.get("md5") or normalized_params.get("notification_secret") or ""
-    logger.info(f"SHA1 computed={sha1_hex}, received={received_hash}")
-
-    # Validate signature and other checks
-    is_valid = (
-        received_hash.lower() == sha1_hex.lower() and
-        normalized_params.get("codepro", "false").lower() == "false" and
-        normalized_params.get("currency") == "643"  # RUB
-    )
-    if not is_valid:
-        logger.warning("Invalid webhook signature or parameters")
-        raise HTTPException(status_code=400, detail="Invalid signature or parameters")
-
-    # Extract user_id from label
-    label = normalized_params.get("label", "")
-    user_id: Optional[int] = None
-    if label.isdigit():
-        user_id = int(label)
-    elif label.startswith("user_id:") and label.split(":", 1)[1].isdigit():
-        user_id = int(label.split(":", 1)[1])
+    # Get data from request (values are stringified during normalization below)
+    body = await _read_body(request)
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            params = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(params, dict):
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
     else:
-        digits = "".join(ch for ch in label if ch.isdigit())
-        if digits:
-            user_id = int(digits)
+        # YooMoney posts application/x-www-form-urlencoded
+        params = dict(parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True))
 
-    if user_id is None:
-        logger.warning("Could not extract user_id from label")
-        raise HTTPException(status_code=400, detail="Invalid user_id in label")
+    # Full params (incl. hash/secret fields) only at DEBUG
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook params: %s", params)
 
-    # Process payment: increment balance
+    # Signature check + user_id extraction (see yoomoney_verify)
     try:
-        new_balance = increment_user_balance(user_id, 1)  # Adjust delta as needed
-        logger.info(f"Payment processed for user {user_id}, new balance: {new_balance}")
+        user_id = verify_and_extract(params, _SECRET_BYTES)
+    except VerificationError as e:
+        logger.warning("Webhook rejected: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Notify user via Telegram
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"Платеж получен! Ваш баланс: {new_balance} генераций."
-        )
+    # Process payment: increment balance
+    try:
+        # sqlite3 is blocking; run it in a worker thread so concurrent webhooks keep flowing
+        new_balance = await asyncio.to_thread(increment_user_balance, user_id, 1)  # Adjust delta as needed
+        logger.info("Payment processed for user %s, new balance: %s", user_id, new_balance)
     except Exception as e:
-        logger.exception(f"Error processing payment for user {user_id}")
+        logger.exception("Error processing payment for user %s", user_id)
         raise HTTPException(status_code=500, detail="Internal error processing payment")
 
-    return {"status": "ok"}
+    # Ack YooMoney as soon as the balance is stored; notify the user via Telegram afterwards
+    return Response(
+        content=_OK_BODY,
+        media_type="application/json",
+        background=BackgroundTask(_notify_user, request.app.state.bot, user_id, new_balance),
+    )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # loop/http "auto" pick uvloop + httptools from uvicorn[standard] where available;
+    # requests are already logged by the handler, so the access log is off
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto", access_log=False)
\ No newline at end of file
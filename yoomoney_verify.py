@@ -0,0 +1,129 @@
+"""
+YooMoney notification verification: normalize fields, check the SHA-1 signature,
+extract the paying user's id.
+
+Kept free of web-framework types and fully annotated so it can be compiled with
+mypyc (`mypyc yoomoney_verify.py`); without a built extension the plain module
+is imported as usual.
+"""
+import hashlib
+import hmac
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# YooMoney keys (lowercased) -> canonical names
+_KEY_MAP: Dict[str, str] = {
+    "notificationtype": "notification_type",
+    "notification_type": "notification_type",
+    "operationid": "operation_id",
+    "operation_id": "operation_id",
+    "amount": "amount",
+    "currency": "currency",
+    "datetime": "datetime",
+    "sender": "sender",
+    "codepro": "codepro",
+    "label": "label",
+    "sha1-hash": "sha1_hash",
+    "sha1_hash": "sha1_hash",
+    "md5": "md5",
+    "notification_secret": "notification_secret",
+    "secret": "secret",
+}
+
+# Field order of the signature string (secret is appended last)
+_ORDERED_KEYS: Tuple[str, ...] = (
+    "notification_type",
+    "operation_id",
+    "amount",
+    "currency",
+    "datetime",
+    "sender",
+    "codepro",
+    "label",
+)
+
+# Any accepted spelling of a signed field -> its slot in _ORDERED_KEYS; the
+# *_IDX slots are also used by kling_bot's pasted-notification handler
+_ORDERED_KEY_INDEX: Dict[str, int] = {
+    alias: _ORDERED_KEYS.index(canon) for alias, canon in _KEY_MAP.items() if canon in _ORDERED_KEYS
+}
+CODEPRO_IDX = _ORDERED_KEYS.index("codepro")
+CURRENCY_IDX = _ORDERED_KEYS.index("currency")
+LABEL_IDX = _ORDERED_KEYS.index("label")
+
+# First run of digits in a free-form label (e.g. "<id><full name>" from the bot)
+_DIGITS_RE = re.compile(rb"\d+")
+
+# Lowercases hex digits in place of str.lower() on the received hash
+_LOWER_TBL = bytes.maketrans(b"ABCDEF", b"abcdef")
+
+
+class VerificationError(ValueError):
+    # Message is safe to return to the client as the error detail
+    pass
+
+
+def _sha1_hex(buf: bytes) -> str:
+    # hashlib's sha1 is OpenSSL's, which already dispatches to SHA-NI on CPUs that
+    # have it; usedforsecurity=False skips the FIPS policy check for legacy SHA-1
+    return hashlib.sha1(buf, usedforsecurity=False).hexdigest()
+
+
+def normalize(params: Dict[str, object]) -> Tuple[List[Optional[bytes]], Dict[str, str]]:
+    # Single pass: signed fields go straight into their slot (as bytes, ready for
+    # hashing), the remaining known keys (hash variants, secret) into a small dict,
+    # unknown keys are dropped. Slots of absent fields stay None, so "missing" and
+    # "sent empty" remain distinguishable.
+    vals: List[Optional[bytes]] = [None] * len(_ORDERED_KEYS)
+    extra: Dict[str, str] = {}
+    for k, v in params.items():
+        lk = k if k.islower() else k.lower()
+        idx = _ORDERED_KEY_INDEX.get(lk)
+        if idx is not None:
+            vals[idx] = str(v).encode("utf-8")
+        elif lk in _KEY_MAP:
+            extra[_KEY_MAP[lk]] = str(v)
+    return vals, extra
+
+
+def compute_sig(vals: List[Optional[bytes]], secret: bytes) -> str:
+    # absent fields are signed as empty strings
+    return _sha1_hex(b"&".join([v or b"" for v in vals]) + b"&" + secret)
+
+
+def extract_user_id(label: bytes) -> Optional[int]:
+    if label.startswith(b"user_id:"):
+        tail = label[8:]
+        return int(tail) if tail.isdigit() else None
+    if label.isdigit():
+        return int(label)
+    m = _DIGITS_RE.search(label)
+    return int(m.group(0)) if m else None
+
+
+def verify_and_extract(params: Dict[str, object], secret: bytes) -> int:
+    vals, extra = normalize(params)
+
+    # Cheap field checks first so rejected notifications never reach the hash
+    codepro = vals[CODEPRO_IDX]
+    if codepro is not None and codepro.lower() != b"false":
+        raise VerificationError("Invalid signature or parameters")
+    if vals[CURRENCY_IDX] != b"643":  # RUB
+        raise VerificationError("Invalid signature or parameters")
+
+    # Build signature string and compute SHA-1
+    sha1_hex = compute_sig(vals, secret or extra.get("secret", "").encode("utf-8"))
+    received_hash = extra.get("sha1_hash") or extra.get("md5") or extra.get("notification_secret") or ""
+    logger.info("SHA1 computed=%s, received=%s", sha1_hex, received_hash)
+
+    # hexdigest() is already lowercase; compare in constant time
+    if not hmac.compare_digest(received_hash.encode("ascii", "replace").translate(_LOWER_TBL), sha1_hex.encode("ascii")):
+        raise VerificationError("Invalid signature or parameters")
+
+    user_id = extract_user_id(vals[LABEL_IDX] or b"")
+    if user_id is None:
+        raise VerificationError("Invalid user_id in label")
+    return user_id